@@ -1,18 +1,28 @@
+import os
 import pandas as pd
 from sklearn.linear_model import LinearRegression
 import joblib
 
-# Load data
-data = pd.read_csv('data/cloud_costs.csv')
+# Paths relative to this file, so training works from any working directory
+_THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_PATH = os.path.join(_THIS_DIR, 'data', 'cloud_costs.csv')
+MODEL_PATH = os.path.join(_THIS_DIR, 'model', 'cost_model.pkl')
 
-# Features and label
-X = data[['cpu_cores', 'ram_gb', 'storage_gb', 'transfer_gb', 'labor_hours']]
-y = data['total_cost']
+def main():
+    # Load data
+    data = pd.read_csv(DATA_PATH)
 
-# Train model
-model = LinearRegression()
-model.fit(X, y)
+    # Features and label
+    X = data[['cpu_cores', 'ram_gb', 'storage_gb', 'transfer_gb', 'labor_hours']]
+    y = data['total_cost']
 
-# Save model
-joblib.dump(model, 'model/cost_model.pkl')
-print("Model trained and saved.")
+    # Train model
+    model = LinearRegression()
+    model.fit(X, y)
+
+    # Save model
+    joblib.dump(model, MODEL_PATH)
+    print("Model trained and saved.")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 # cost_estimator/scripts/app.py
+import orjson
 from flask import Flask, jsonify, request
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 
 # Blueprints (local modules)
@@ -7,8 +9,24 @@ from cost_prediction import predictor_bp
 from update_instances import rec_bp, warm_rec_cache
 from provision import provision_bp  # make sure this import exists if you added provision.py
 
+class OrjsonProvider(JSONProvider):
+    """Serve jsonify()/request.get_json() through orjson instead of the stdlib json module."""
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=self._OPTIONS).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # jsonify(): hand orjson's bytes straight to the response, skipping decode + re-encode
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self._OPTIONS), mimetype="application/json")
+
 def create_app() -> Flask:
     app = Flask(__name__)
+    app.json = OrjsonProvider(app)
 
     # Strong, explicit CORS for all routes & methods
     CORS(
@@ -0,0 +1,54 @@
+# cost_estimator/scripts/aws_clients.py
+# One boto3 session and one client per (service, region) for the whole app, shared by
+# the recommendations and provision blueprints.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+AWS_PROFILE_NAME = os.getenv("AWS_PROFILE") or os.getenv("CLOUD_MIGRATION_AWS_PROFILE")
+
+# boto3 sessions are not thread-safe while creating clients; serialize construction
+_client_lock = threading.Lock()
+
+# boto3/botocore are imported on first use, not at app import: loading them costs a few
+# hundred ms, which workers that never talk to AWS shouldn't pay at startup
+
+@lru_cache(maxsize=1)
+def aws_config():
+    from botocore.config import Config
+    # Shared by every client: adaptive retries for throttling, a bigger pool for concurrent
+    # requests, keep-alive on idle sockets between calls, and bounded timeouts
+    return Config(
+        retries={"max_attempts": 10, "mode": "adaptive"},
+        max_pool_connections=50,
+        tcp_keepalive=True,
+        connect_timeout=5,
+        read_timeout=30,
+    )
+
+@lru_cache(maxsize=1)
+def session():
+    import boto3
+    if AWS_PROFILE_NAME:
+        return boto3.session.Session(profile_name=AWS_PROFILE_NAME)
+    return boto3.session.Session()
+
+@lru_cache(maxsize=None)
+def client(service: str, region: str):
+    # Clients are thread-safe once built; reuse one per region (and its connection pool)
+    with _client_lock:
+        return session().client(service, region_name=region, config=aws_config())
+
+def ec2(region: str):
+    return client("ec2", region)
+
+def ssm(region: str):
+    return client("ssm", region)
+
+@lru_cache(maxsize=1)
+def aws_pool() -> ThreadPoolExecutor:
+    # One process-wide pool for fanning out independent AWS calls inside a request, instead
+    # of spinning threads up and down per request. Only submit leaf calls (never work that
+    # itself waits on this pool), so concurrent requests can't starve each other into deadlock.
+    return ThreadPoolExecutor(max_workers=32, thread_name_prefix="aws")
@@ -12,9 +12,13 @@ _THIS_DIR = os.path.dirname(os.path.abspath(__file__))
 _DEFAULT_MODEL_PATH = os.path.normpath(os.path.join(_THIS_DIR, "..", "model", "cost_model.pkl"))
 MODEL_PATH = os.getenv("MODEL_PATH", _DEFAULT_MODEL_PATH)
 
+# Must match the training column order in cost_predictor.py
+_FEATURE_KEYS = ("cpu_cores", "ram_gb", "storage_gb", "transfer_gb", "labor_hours")
+
 _model = None
+_linear = None  # (coef, intercept) when the model is a plain linear regressor
 def _load_model():
-    global _model
+    global _model, _linear
     if _model is None:
         try:
             _model = joblib.load(MODEL_PATH)
@@ -22,6 +26,14 @@ def _load_model():
         except Exception as e:
             print("[predictor] Failed to load model:", e)
             _model = None
+            return _model
+        # Linear models predict as coef . x + intercept; skip sklearn's per-call validation
+        coef = getattr(_model, "coef_", None)
+        if coef is not None and np.size(coef) == len(_FEATURE_KEYS):
+            _linear = (
+                np.asarray(coef, dtype=np.float64).ravel(),
+                float(np.ravel(_model.intercept_)[0]),
+            )
     return _model
 
 @predictor_bp.route("/predict", methods=["POST"])
@@ -35,20 +47,20 @@ def predict():
         return jsonify({"error": "Invalid or missing JSON body"}), 400
 
     try:
-        features = np.array([
-            data["cpu_cores"],
-            data["ram_gb"],
-            data["storage_gb"],
-            data["transfer_gb"],
-            data["labor_hours"]
-        ]).reshape(1, -1)
+        features = np.fromiter(
+            (float(data[k]) for k in _FEATURE_KEYS), dtype=np.float64, count=len(_FEATURE_KEYS)
+        )
     except KeyError as e:
         return jsonify({"error": f"Missing input field: {str(e)}"}), 400
     except Exception as e:
         return jsonify({"error": f"Invalid input data: {str(e)}"}), 400
 
     try:
-        prediction = float(model.predict(features)[0])
+        if _linear is not None:
+            coef, intercept = _linear
+            prediction = float(features @ coef) + intercept
+        else:
+            prediction = float(model.predict(features.reshape(1, -1))[0])
         return jsonify({"estimated_cost": round(prediction, 2)})
     except Exception as e:
         return jsonify({"error": f"Model prediction failed: {str(e)}"}), 500
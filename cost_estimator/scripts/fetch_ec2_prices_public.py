@@ -4,8 +4,11 @@ Builds a local snapshot of EC2 On-Demand Linux (Shared) prices for 1+ regions
 using AWS's public offer files (no IAM needed).
 Writes: cost_estimator/data/pricing/ec2_prices_<region>.json
 """
-import argparse, json, os, sys, time
+import argparse, os, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import ijson
+import orjson
 import requests
 
 BASE = "https://pricing.us-east-1.amazonaws.com"
@@ -25,52 +28,64 @@ def region_offer_url(region_code: str) -> str:
     rel = regions[region_code]["currentVersionUrl"]
     return f"{BASE}{rel}"
 
+def _cheapest_hourly(sku_terms: dict):
+    """Cheapest $/Hr across every dimension of one SKU's On-Demand terms."""
+    best = None
+    for offer in sku_terms.values():
+        dims = offer.get("priceDimensions", {})
+        for dim in dims.values():
+            if dim.get("unit") != "Hrs":
+                continue
+            usd = (dim.get("pricePerUnit") or {}).get("USD")
+            if not usd:
+                continue
+            try:
+                v = float(usd)
+                best = v if (best is None or v < best) else best
+            except Exception:
+                pass
+    return best
+
 def build_snapshot(region_code: str) -> dict:
     url = region_offer_url(region_code)
-    r = requests.get(url, timeout=180)
-    r.raise_for_status()
-    j = r.json()
-
-    products = j.get("products", {})
-    terms = j.get("terms", {}).get("OnDemand", {})
-
     prices = {}
+    with requests.get(url, stream=True, timeout=180) as r, tempfile.TemporaryFile() as fh:
+        r.raise_for_status()
+        # Offer files are hundreds of MB: spool to disk and stream-parse with ijson, so
+        # concurrent regions (--workers) don't each hold a whole offer in memory
+        for chunk in r.iter_content(chunk_size=1 << 20):
+            fh.write(chunk)
 
-    # Walk products -> keep Compute Instance, Linux, Shared, NA
-    for sku, prod in products.items():
-        attrs = prod.get("attributes", {})
-        if attrs.get("productFamily") not in ("Compute Instance", "Compute Instance (bare metal)"):
-            continue
-        if attrs.get("operatingSystem") != "Linux":
-            continue
-        if attrs.get("tenancy") != "Shared":
-            continue
-        if attrs.get("preInstalledSw") != "NA":
-            continue
-        itype = attrs.get("instanceType")
-        if not itype:
-            continue
+        # Walk products -> keep Compute Instance, Linux, Shared, NA
+        fh.seek(0)
+        wanted = {}  # sku -> instanceType
+        for sku, prod in ijson.kvitems(fh, "products"):
+            attrs = prod.get("attributes", {})
+            if attrs.get("productFamily") not in ("Compute Instance", "Compute Instance (bare metal)"):
+                continue
+            if attrs.get("operatingSystem") != "Linux":
+                continue
+            if attrs.get("tenancy") != "Shared":
+                continue
+            if attrs.get("preInstalledSw") != "NA":
+                continue
+            itype = attrs.get("instanceType")
+            if not itype:
+                continue
+            wanted[sku] = itype
 
-        # Find the cheapest $/Hr across dimensions of this SKU
-        ond = terms.get(sku, {})
-        best = None
-        for offer in ond.values():
-            dims = offer.get("priceDimensions", {})
-            for dim in dims.values():
-                if dim.get("unit") != "Hrs":
-                    continue
-                usd = (dim.get("pricePerUnit") or {}).get("USD")
-                if not usd:
-                    continue
-                try:
-                    v = float(usd)
-                    best = v if (best is None or v < best) else best
-                except Exception:
-                    pass
-        if best is not None:
-            # Keep minimum across SKUs that map to the same instanceType
-            if (itype not in prices) or (best < prices[itype]):
-                prices[itype] = best
+        # Then the On-Demand terms of just those SKUs
+        fh.seek(0)
+        for sku, sku_terms in ijson.kvitems(fh, "terms.OnDemand"):
+            itype = wanted.get(sku)
+            if itype is None:
+                continue
+            best = _cheapest_hourly(sku_terms or {})
+            if best is not None:
+                # Keep minimum across SKUs that map to the same instanceType (one lookup per SKU)
+                cur = prices.get(itype)
+                if cur is None or best < cur:
+                    prices[itype] = best
 
     snapshot = {
         "region": region_code,
@@ -85,18 +100,33 @@ def build_snapshot(region_code: str) -> dict:
 def write_snapshot(region_code: str, snap: dict):
     out = PRICE_DIR / f"ec2_prices_{region_code}.json"
     tmp = out.with_suffix(".json.tmp")
-    tmp.write_text(json.dumps(snap, indent=2), encoding="utf-8")
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(snap, option=orjson.OPT_INDENT_2))
+        f.flush()
+        os.fsync(f.fileno())  # durable before the rename makes it visible
     tmp.replace(out)
+    dir_fd = os.open(out.parent, os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
     return out
 
+def _fetch_region(region_code: str):
+    snap = build_snapshot(region_code)
+    return write_snapshot(region_code, snap), snap["count"]
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("regions", nargs="+", help="Region codes (e.g., us-east-1 ap-south-1)")
+    ap.add_argument("--workers", type=int, default=4,
+                    help="Regions downloaded concurrently (each offer file is large; keep this small)")
     args = ap.parse_args()
-    for region in args.regions:
-        snap = build_snapshot(region)
-        path = write_snapshot(region, snap)
-        print(f"✅ wrote {path}  (count={snap['count']})")
+    regions = list(dict.fromkeys(args.regions))
+    # Downloads are network-bound, so fan out across regions
+    with ThreadPoolExecutor(max_workers=max(1, min(args.workers, len(regions)))) as ex:
+        for path, count in ex.map(_fetch_region, regions):
+            print(f"✅ wrote {path}  (count={count})")
 
 if __name__ == "__main__":
     try:
@@ -1,34 +1,87 @@
-# cost_estimator/scripts/provision_aws.py
+# cost_estimator/scripts/provision.py
 import os
 import time
 import uuid
-from typing import Dict, Any, Optional
-
-import boto3
-from botocore.config import Config
-from botocore.exceptions import ClientError
+import sqlite3
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+import orjson
+from botocore.exceptions import BotoCoreError, ClientError
 from flask import Blueprint, request, jsonify
 
+from aws_clients import aws_pool, ec2, ssm
+
 provision_bp = Blueprint("provision", __name__)
 
-AWS_PROFILE_NAME = os.getenv("AWS_PROFILE") or os.getenv("CLOUD_MIGRATION_AWS_PROFILE")
 DEFAULT_REGION = os.getenv("TARGET_REGION_CODE", "us-east-1")
 
 STACK_TAG_KEY = "CloudMigStack"       # used on all created resources
 NAME_TAG_KEY  = "Name"
 
-# in-memory stack registry (also do tag-based discovery on destroy)
-_STACKS: Dict[str, Dict[str, Any]] = {}
-
-def _session():
-    if AWS_PROFILE_NAME:
-        return boto3.session.Session(profile_name=AWS_PROFILE_NAME)
-    return boto3.session.Session()
+# Instance state waiters: poll every 5s (boto3 default is 15s) for up to the same ~10 min
+WAITER_CONFIG = {"Delay": 5, "MaxAttempts": 120}
+
+# Before deleting a stack's SG/VPC, poll until its ENIs are released: every 5s for up to
+# ~2 min (terminated instances' ENIs usually clear in seconds)
+ENI_POLL_DELAY = 5
+ENI_POLL_ATTEMPTS = 24
+
+# EC2 accepts at most 200 values in one filter (e.g. tag:CloudMigStack)
+FILTER_VALUES_MAX = 200
+
+# A region's default VPC/subnet practically never changes; skip re-describing them on every create
+DEFAULT_NET_TTL = int(os.getenv("DEFAULT_NET_TTL", "600"))
+_DEFAULT_NET: Dict[str, Dict[str, Any]] = {}
+
+# stack registry: a small SQLite table, so stacks survive restarts and each create/destroy
+# writes one row instead of the whole registry (destroy still falls back to tag-based
+# discovery for unknown stacks)
+STATE_DIR = Path(__file__).resolve().parents[1] / "data" / "provision"
+STATE_DIR.mkdir(parents=True, exist_ok=True)
+STATE_DB = STATE_DIR / "state.db"
+
+_db_conn: Optional[sqlite3.Connection] = None
+_stacks_lock = threading.Lock()
+
+def _db() -> sqlite3.Connection:
+    # opened on first use (i.e. after any worker fork); shared by this process's threads
+    global _db_conn
+    if _db_conn is None:
+        conn = sqlite3.connect(STATE_DB, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")      # readers don't block the writer
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS stacks ("
+            " stack_id TEXT PRIMARY KEY, region TEXT, instance_json BLOB, network_json BLOB, ts INTEGER)"
+        )
+        _db_conn = conn
+    return _db_conn
+
+def _get_stack(stack_id: str) -> Optional[Dict[str, Any]]:
+    with _stacks_lock:
+        row = _db().execute(
+            "SELECT region, instance_json, network_json, ts FROM stacks WHERE stack_id = ?", (stack_id,)
+        ).fetchone()
+    if row is None:
+        return None
+    region, inst, net, ts = row
+    return {"stack_id": stack_id, "region": region, "instance": orjson.loads(inst),
+            "network": orjson.loads(net), "ts": ts}
+
+def _put_stack(record: Dict[str, Any]):
+    with _stacks_lock:
+        _db().execute(
+            "INSERT OR REPLACE INTO stacks (stack_id, region, instance_json, network_json, ts) VALUES (?, ?, ?, ?, ?)",
+            (record["stack_id"], record.get("region"), orjson.dumps(record.get("instance")),
+             orjson.dumps(record.get("network")), record.get("ts")),
+        )
 
-def ec2(region: str):
-    return _session().client("ec2", region_name=region, config=Config(
-        retries={"max_attempts": 10, "mode": "standard"}
-    ))
+def _pop_stack(stack_id: str):
+    with _stacks_lock:
+        _db().execute("DELETE FROM stacks WHERE stack_id = ?", (stack_id,))
 
 def _tag_spec(resource: str, stack_id: str, name: str):
     return [{
@@ -58,42 +111,82 @@ def _find_default_vpc(cli, region: str) -> Optional[str]:
     return vpcs[0]["VpcId"] if vpcs else None
 
 def _get_default_subnet(cli, vpc_id: str) -> Optional[str]:
-    # any default-for-az subnet within the default VPC
-    resp = cli.describe_subnets(Filters=[{"Name": "vpc-id", "Values": [vpc_id]}])
-    for sn in resp.get("Subnets", []):
-        return sn["SubnetId"]  # pick first
-    return None
+    # any default-for-az subnet within the default VPC; filtered server-side, one small page
+    resp = cli.describe_subnets(
+        Filters=[
+            {"Name": "vpc-id", "Values": [vpc_id]},
+            {"Name": "default-for-az", "Values": ["true"]},
+        ],
+        MaxResults=5,  # API minimum
+    )
+    subnets = resp.get("Subnets") or []
+    return subnets[0]["SubnetId"] if subnets else None
+
+def _default_network(cli, region: str) -> Tuple[Optional[str], Optional[str]]:
+    """(default VPC id, one of its subnets) for the region, cached for DEFAULT_NET_TTL."""
+    cached = _DEFAULT_NET.get(region)
+    if cached and (time.time() - cached["ts"] < DEFAULT_NET_TTL):
+        return cached["vpc_id"], cached["subnet_id"]
+    vpc_id = _find_default_vpc(cli, region)
+    subnet_id = _get_default_subnet(cli, vpc_id) if vpc_id else None
+    _DEFAULT_NET[region] = {"ts": time.time(), "vpc_id": vpc_id, "subnet_id": subnet_id}
+    return vpc_id, subnet_id
+
+# errors meaning the cached default VPC/subnet no longer exists (deleted or replaced)
+_STALE_NETWORK_CODES = ("InvalidSubnetID.NotFound", "InvalidVpcID.NotFound")
+
+def _forget_stale_default_network(region: str, e: ClientError):
+    if e.response.get("Error", {}).get("Code") in _STALE_NETWORK_CODES:
+        _DEFAULT_NET.pop(region, None)
 
 def _create_min_vpc(cli, stack_id: str, region: str) -> Dict[str, Any]:
     # VPC
     v = cli.create_vpc(CidrBlock="10.0.0.0/16", TagSpecifications=_tag_spec("vpc", stack_id, f"mig-vpc-{stack_id[:8]}"))
     vpc_id = v["Vpc"]["VpcId"]
-    cli.modify_vpc_attribute(VpcId=vpc_id, EnableDnsSupport={"Value": True})
-    cli.modify_vpc_attribute(VpcId=vpc_id, EnableDnsHostnames={"Value": True})
 
-    # Subnet
-    sn = cli.create_subnet(
+    ex = aws_pool()
+    # The API takes one VPC attribute per call, but the two calls are independent of each
+    # other and of everything below; they run alongside the creates
+    dns_fs = [
+        ex.submit(cli.modify_vpc_attribute, VpcId=vpc_id, EnableDnsSupport={"Value": True}),
+        ex.submit(cli.modify_vpc_attribute, VpcId=vpc_id, EnableDnsHostnames={"Value": True}),
+    ]
+    # Subnet, IGW and route table only need the VPC: create them concurrently
+    sn_f = ex.submit(
+        cli.create_subnet,
         VpcId=vpc_id,
         CidrBlock="10.0.1.0/24",
         TagSpecifications=_tag_spec("subnet", stack_id, f"mig-subnet-{stack_id[:8]}"),
     )
-    subnet_id = sn["Subnet"]["SubnetId"]
-    cli.modify_subnet_attribute(SubnetId=subnet_id, MapPublicIpOnLaunch={"Value": True})
+    igw_f = ex.submit(
+        cli.create_internet_gateway,
+        TagSpecifications=_tag_spec("internet-gateway", stack_id, f"mig-igw-{stack_id[:8]}"),
+    )
+    rt_f = ex.submit(
+        cli.create_route_table,
+        VpcId=vpc_id,
+        TagSpecifications=_tag_spec("route-table", stack_id, f"mig-rt-{stack_id[:8]}"),
+    )
+    subnet_id = sn_f.result()["Subnet"]["SubnetId"]
+    igw_id = igw_f.result()["InternetGateway"]["InternetGatewayId"]
+    rt_id = rt_f.result()["RouteTable"]["RouteTableId"]
 
-    # IGW
-    igw = cli.create_internet_gateway(TagSpecifications=_tag_spec("internet-gateway", stack_id, f"mig-igw-{stack_id[:8]}"))
-    igw_id = igw["InternetGateway"]["InternetGatewayId"]
-    cli.attach_internet_gateway(InternetGatewayId=igw_id, VpcId=vpc_id)
+    # Public IPs on the subnet, IGW attach and RT association are independent too
+    map_f = ex.submit(cli.modify_subnet_attribute, SubnetId=subnet_id, MapPublicIpOnLaunch={"Value": True})
+    attach_f = ex.submit(cli.attach_internet_gateway, InternetGatewayId=igw_id, VpcId=vpc_id)
+    assoc_f = ex.submit(cli.associate_route_table, RouteTableId=rt_id, SubnetId=subnet_id)
 
-    # Route table + default route
-    rt = cli.create_route_table(VpcId=vpc_id, TagSpecifications=_tag_spec("route-table", stack_id, f"mig-rt-{stack_id[:8]}"))
-    rt_id = rt["RouteTable"]["RouteTableId"]
+    # Default route needs the IGW attached
+    attach_f.result()
     try:
         cli.create_route(RouteTableId=rt_id, DestinationCidrBlock="0.0.0.0/0", GatewayId=igw_id)
     except ClientError as e:
         if e.response.get("Error", {}).get("Code") != "RouteAlreadyExists":
             raise
-    cli.associate_route_table(RouteTableId=rt_id, SubnetId=subnet_id)
+    map_f.result()
+    assoc_f.result()
+    for f in dns_fs:
+        f.result()
 
     return {
         "created_vpc": True,
@@ -103,38 +196,18 @@ def _create_min_vpc(cli, stack_id: str, region: str) -> Dict[str, Any]:
         "route_table_id": rt_id,
     }
 
-def _get_or_create_sg(cli, vpc_id: str, stack_id: str) -> Dict[str, Any]:
-    # try find SG by stack tag
-    resp = cli.describe_security_groups(
-        Filters=[
-            {"Name": f"tag:{STACK_TAG_KEY}", "Values": [stack_id]},
-            {"Name": "vpc-id", "Values": [vpc_id]},
-        ]
+def _create_sg(cli, vpc_id: str, stack_id: str) -> Dict[str, Any]:
+    # stack_id is fresh for every create, so there is no existing SG to look up; tags go
+    # inline with the create
+    sg = cli.create_security_group(
+        GroupName=f"mig-sg-{stack_id[:8]}",
+        Description=f"Mig SG {stack_id}",
+        VpcId=vpc_id,
+        TagSpecifications=_tag_spec("security-group", stack_id, f"mig-sg-{stack_id[:8]}"),
     )
-    if resp.get("SecurityGroups"):
-        sg_id = resp["SecurityGroups"][0]["GroupId"]
-        created = False
-    else:
-        sg = cli.create_security_group(
-            GroupName=f"mig-sg-{stack_id[:8]}",
-            Description=f"Mig SG {stack_id}",
-            VpcId=vpc_id,
-            TagSpecifications=_tag_spec("security-group", stack_id, f"mig-sg-{stack_id[:8]}"),
-        )
-        sg_id = sg["GroupId"]
-        created = True
-
-    # egress: allow all
-    try:
-        cli.authorize_security_group_egress(
-            GroupId=sg_id,
-            IpPermissions=[{"IpProtocol": "-1", "IpRanges": [{"CidrIp": "0.0.0.0/0"}]}],
-        )
-    except ClientError as e:
-        if not _ignore_duplicate_rule(e):
-            raise
+    sg_id = sg["GroupId"]
 
-    # ingress: SSH (22)
+    # A new VPC SG already allows all egress; only SSH ingress needs adding
     try:
         cli.authorize_security_group_ingress(
             GroupId=sg_id,
@@ -147,16 +220,18 @@ def _get_or_create_sg(cli, vpc_id: str, stack_id: str) -> Dict[str, Any]:
         if not _ignore_duplicate_rule(e):
             raise
 
-    return {"security_group_id": sg_id, "created_sg": created}
+    return {"security_group_id": sg_id, "created_sg": True}
 
 # ---------------------------
 # Instance create / status
 # ---------------------------
-def _run_instance(cli, region: str, stack_id: str, instance_type: str, subnet_id: str, sg_id: str,
+def _run_instance(cli, stack_id: str, instance_type: str, ami_id: str, subnet_id: str, sg_id: str,
                   tag_name: str, volume_gb: int) -> Dict[str, Any]:
     resp = cli.run_instances(
         MinCount=1, MaxCount=1,
-        ImageId=_pick_ami(cli, region),
+        # idempotency token: a retried launch returns the original instance, not a second one
+        ClientToken=stack_id,
+        ImageId=ami_id,
         InstanceType=instance_type,
         NetworkInterfaces=[{
             "AssociatePublicIpAddress": True,
@@ -174,50 +249,207 @@ def _run_instance(cli, region: str, stack_id: str, instance_type: str, subnet_id
             *_tag_spec("network-interface", stack_id, f"mig-eni-{stack_id[:8]}"),
         ]
     )
-    inst = resp["Instances"][0]
-    inst_id = inst["InstanceId"]
-    cli.get_waiter("instance_running").wait(InstanceIds=[inst_id])
-    time.sleep(1.0)
-    di = cli.describe_instances(InstanceIds=[inst_id])
-    i = di["Reservations"][0]["Instances"][0]
+    # Answer from the launch response instead of blocking until "running": the instance is
+    # still pending here, so public_ip is usually None; /provision/status reports it later
+    i = resp["Instances"][0]
     return {
-        "id": inst_id,
+        "id": i["InstanceId"],
         "type": i.get("InstanceType"),
         "state": i.get("State", {}).get("Name"),
         "public_ip": i.get("PublicIpAddress"),
     }
 
-def _pick_ami(cli, region: str) -> str:
+# /provision/status coalescing: concurrent polls in one region share a describe_instances.
+# A caller with no describe in flight for its region describes right away; callers that
+# arrive while one is in flight join the next batch, which runs (as one call for all of
+# them, up to 200 values per filter) as soon as the current describe returns.
+STATUS_BATCH_MAX = FILTER_VALUES_MAX
+# region -> {"busy": describe in flight, "queue": batches waiting for their turn}
+_status_state: Dict[str, Dict[str, Any]] = {}
+_status_lock = threading.Lock()
+
+def _instances_by_stack(cli, stack_ids: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    pages = cli.get_paginator("describe_instances").paginate(
+        Filters=[{"Name": f"tag:{STACK_TAG_KEY}", "Values": stack_ids}],
+        PaginationConfig={"PageSize": 1000},
+    )
+    for page in pages:
+        for res in page.get("Reservations", []):
+            for i in res.get("Instances", []):
+                tag = next((t["Value"] for t in i.get("Tags", []) if t["Key"] == STACK_TAG_KEY), None)
+                out.setdefault(tag, []).append({
+                    "id": i["InstanceId"], "state": i["State"]["Name"], "type": i.get("InstanceType"),
+                    "public_ip": i.get("PublicIpAddress"),
+                })
+    return out
+
+def _new_status_batch(stack_id: str) -> Dict[str, Any]:
+    return {"stack_ids": {stack_id}, "go": threading.Event(), "done": threading.Event(),
+            "result": {}, "error": None}
+
+def _stack_instances(cli, region: str, stack_id: str) -> List[Dict[str, Any]]:
+    with _status_lock:
+        st = _status_state.setdefault(region, {"busy": False, "queue": []})
+        queue = st["queue"]
+        if not st["busy"]:
+            st["busy"] = True
+            batch, runner = _new_status_batch(stack_id), True
+            batch["go"].set()  # nothing in flight: no reason to wait
+        elif queue and len(queue[-1]["stack_ids"]) < STATUS_BATCH_MAX:
+            batch, runner = queue[-1], False
+            batch["stack_ids"].add(stack_id)
+        else:
+            batch, runner = _new_status_batch(stack_id), True
+            queue.append(batch)
+    if runner:
+        batch["go"].wait()  # set once the region's previous describe has returned
+        try:
+            # the batch left the queue before "go" was set, so its stack ids are final
+            batch["result"] = _instances_by_stack(cli, list(batch["stack_ids"]))
+        except Exception as e:
+            batch["error"] = e
+        finally:
+            with _status_lock:
+                if queue:
+                    queue.pop(0)["go"].set()  # hand the region to the next batch
+                else:
+                    st["busy"] = False
+            batch["done"].set()
+    else:
+        batch["done"].wait()
+    if batch["error"] is not None:
+        raise batch["error"]
+    return batch["result"].get(stack_id, [])
+
+# Public parameters AWS keeps pointed at the latest Amazon Linux 2023 AMI in every region
+AL2023_AMI_PARAM = "/aws/service/ami-amazon-linux-latest/al2023-ami-kernel-default-{arch}"
+
+# Resolved AMI ids per (region, arch); new AL2023 images ship at most every few days
+AMI_CACHE_TTL = int(os.getenv("AMI_CACHE_TTL", "3600"))
+_AMI_CACHE: Dict[Tuple[str, str], Tuple[float, str]] = {}
+_ami_lock = threading.Lock()
+KNOWN_AMIS_FILE = STATE_DIR.parent / "known_amis.json"
+_KNOWN_AMIS: Tuple[Optional[int], Dict[str, Dict[str, str]]] = (None, {})  # (file mtime, parsed)
+
+@lru_cache(maxsize=512)
+def _described_arch(region: str, instance_type: str) -> str:
+    # EC2 is the authority on which CPU architecture a type runs (Graviton vs x86);
+    # asked once per type instead of keeping a hand-written list of ARM families.
+    # Raises on failure, so lru_cache only ever keeps real answers.
+    r = ec2(region).describe_instance_types(InstanceTypes=[instance_type])
+    archs = r["InstanceTypes"][0]["ProcessorInfo"]["SupportedArchitectures"]
+    return "x86_64" if "x86_64" in archs else "arm64"
+
+def _instance_arch(region: str, instance_type: str) -> str:
+    try:
+        return _described_arch(region, instance_type)
+    except (ClientError, BotoCoreError, KeyError, IndexError) as e:
+        # not cached: a throttle or blip must not pin Graviton types to x86 AMIs
+        print(f"[provision] Could not resolve architecture of {instance_type}, assuming x86_64:", e)
+        return "x86_64"
+
+def _ami_for_type(cli, region: str, instance_type: str) -> str:
+    return _pick_ami(cli, region, _instance_arch(region, instance_type))
+
+def _pick_ami(cli, region: str, arch: str = "x86_64") -> str:
+    # A pinned id needs no API call at all, and is checked ahead of the cache so a refreshed
+    # known_amis.json takes effect on the next create; a deregistered pin fails the launch
+    pinned = (_known_amis().get(region) or {}).get(arch)
+    if pinned:
+        return pinned
+    cached = _AMI_CACHE.get((region, arch))
+    if cached and (time.time() - cached[0] < AMI_CACHE_TTL):
+        return cached[1]
+    ami_id = _lookup_ami(cli, region, arch)
+    with _ami_lock:
+        _AMI_CACHE[(region, arch)] = (time.time(), ami_id)
+    return ami_id
+
+def _known_amis() -> Dict[str, Dict[str, str]]:
+    """
+    Optional pinned AMIs, {region: {arch: ami_id}}, from data/known_amis.json (absent by
+    default). Re-read whenever the file's mtime changes, so a cron refresh is picked up
+    without a restart; a missing or unreadable file is not cached.
+    """
+    global _KNOWN_AMIS
+    try:
+        with open(KNOWN_AMIS_FILE, "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            cached_mtime, amis = _KNOWN_AMIS
+            if cached_mtime == mtime:
+                return amis
+            data = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    amis = data if isinstance(data, dict) else {}
+    _KNOWN_AMIS = (mtime, amis)
+    return amis
+
+def _lookup_ami(cli, region: str, arch: str) -> str:
+    # One small GetParameter instead of listing and sorting every matching image
+    try:
+        return ssm(region).get_parameter(Name=AL2023_AMI_PARAM.format(arch=arch))["Parameter"]["Value"]
+    except (ClientError, BotoCoreError) as e:
+        print(f"[provision] SSM AMI lookup failed in {region}, scanning images instead:", e)
     owners = ["137112412989", "amazon"]  # Amazon
-    for name in ["al2023-ami-*-x86_64", "amzn2-ami-hvm-*-x86_64-gp2"]:
+    for name in [f"al2023-ami-*-{arch}", f"amzn2-ami-hvm-*-{arch}-gp2"]:
         resp = cli.describe_images(
             Owners=owners,
             Filters=[{"Name": "name", "Values": [name]}, {"Name": "state", "Values": ["available"]}],
         )
-        imgs = sorted(resp.get("Images", []), key=lambda x: x.get("CreationDate", ""), reverse=True)
+        imgs = resp.get("Images", [])
         if imgs:
-            return imgs[0]["ImageId"]
-    r = cli.describe_images(Owners=["amazon"], Filters=[{"Name": "architecture", "Values": ["x86_64"]}], MaxResults=1)
+            return max(imgs, key=lambda x: x.get("CreationDate", ""))["ImageId"]
+    r = cli.describe_images(Owners=["amazon"], Filters=[{"Name": "architecture", "Values": [arch]}], MaxResults=1)
     return r["Images"][0]["ImageId"]
 
 # ---------------------------
 # Destroy helpers (idempotent)
 # ---------------------------
 def _terminate_instances_by_tag(cli, stack_id: str):
-    resp = cli.describe_instances(Filters=[{"Name": f"tag:{STACK_TAG_KEY}", "Values": [stack_id]}])
-    ids = []
-    for res in resp.get("Reservations", []):
-        for inst in res.get("Instances", []):
-            state = inst.get("State", {}).get("Name")
-            if state not in ("shutting-down", "terminated"):
-                ids.append(inst["InstanceId"])
-    if ids:
-        cli.terminate_instances(InstanceIds=ids)
+    _terminate_instances_by_tags(cli, [stack_id])
+
+def _terminate_instances_by_tags(cli, stack_ids: List[str]):
+    """
+    One describe and one terminate per FILTER_VALUES_MAX stacks, then wait for every
+    live instance of the given stacks. No stack ids means nothing to terminate.
+    """
+    stack_ids = list(stack_ids)
+    waits = []
+    for i in range(0, len(stack_ids), FILTER_VALUES_MAX):
+        # only live instances come back: EC2 drops already terminated/shutting-down ones server-side
+        pages = cli.get_paginator("describe_instances").paginate(
+            Filters=[
+                {"Name": f"tag:{STACK_TAG_KEY}", "Values": stack_ids[i : i + FILTER_VALUES_MAX]},
+                {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]},
+            ],
+            PaginationConfig={"PageSize": 1000},
+        )
+        ids = [inst["InstanceId"] for page in pages for res in page.get("Reservations", [])
+               for inst in res.get("Instances", [])]
+        if ids:
+            cli.terminate_instances(InstanceIds=ids)
+            waits.append(ids)
+    for ids in waits:
         try:
-            cli.get_waiter("instance_terminated").wait(InstanceIds=ids)
+            cli.get_waiter("instance_terminated").wait(InstanceIds=ids, WaiterConfig=WAITER_CONFIG)
         except Exception:
             pass
 
+def _delete_with_backoff(fn, **kwargs):
+    """Call a delete API, retrying DependencyViolation with exponential backoff (0.25s doubling, capped at 4s)."""
+    for attempt in range(6):
+        try:
+            fn(**kwargs)
+            return
+        except ClientError as e:
+            if _ignore_not_found(e): return
+            if e.response.get("Error", {}).get("Code") == "DependencyViolation":
+                time.sleep(min(0.25 * 2 ** attempt, 4.0))
+                continue
+            raise
+
 def _disassociate_and_delete_rt(cli, rt_id: str):
     try:
         info = cli.describe_route_tables(RouteTableIds=[rt_id])["RouteTables"][0]
@@ -243,16 +475,7 @@ def _disassociate_and_delete_rt(cli, rt_id: str):
         if not _ignore_not_found(e): raise
 
 def _delete_sg(cli, sg_id: str):
-    for _ in range(5):
-        try:
-            cli.delete_security_group(GroupId=sg_id)
-            return
-        except ClientError as e:
-            if _ignore_not_found(e): return
-            if e.response.get("Error", {}).get("Code") == "DependencyViolation":
-                time.sleep(2.0)
-                continue
-            raise
+    _delete_with_backoff(cli.delete_security_group, GroupId=sg_id)
 
 def _detach_delete_igw(cli, vpc_id: str, igw_id: str):
     try:
@@ -265,53 +488,73 @@ def _detach_delete_igw(cli, vpc_id: str, igw_id: str):
         if not _ignore_not_found(e): raise
 
 def _delete_subnet(cli, subnet_id: str):
-    for _ in range(5):
-        try:
-            cli.delete_subnet(SubnetId=subnet_id)
-            return
-        except ClientError as e:
-            if _ignore_not_found(e): return
-            if e.response.get("Error", {}).get("Code") == "DependencyViolation":
-                time.sleep(2.0)
-                continue
-            raise
+    _delete_with_backoff(cli.delete_subnet, SubnetId=subnet_id)
 
 def _delete_vpc(cli, vpc_id: str):
-    for _ in range(5):
-        try:
-            cli.delete_vpc(VpcId=vpc_id)
-            return
-        except ClientError as e:
-            if _ignore_not_found(e): return
-            if e.response.get("Error", {}).get("Code") == "DependencyViolation":
-                time.sleep(2.0)
-                continue
-            raise
-
-def _discover_network_by_tag(cli, stack_id: str) -> Dict[str, Optional[str]]:
-    out = {"vpc_id": None, "subnet_id": None, "security_group_id": None, "igw_id": None, "route_table_id": None}
-    vpcs = cli.describe_vpcs(Filters=[{"Name": f"tag:{STACK_TAG_KEY}", "Values": [stack_id]}]).get("Vpcs", [])
-    if vpcs: out["vpc_id"] = vpcs[0]["VpcId"]
-    resp = cli.describe_subnets(Filters=[{"Name": f"tag:{STACK_TAG_KEY}", "Values": [stack_id]}])
-    if resp.get("Subnets"): out["subnet_id"] = resp["Subnets"][0]["SubnetId"]
-    resp = cli.describe_security_groups(Filters=[{"Name": f"tag:{STACK_TAG_KEY}", "Values": [stack_id]}])
-    if resp.get("SecurityGroups"): out["security_group_id"] = resp["SecurityGroups"][0]["GroupId"]
-    resp = cli.describe_internet_gateways(Filters=[{"Name": f"tag:{STACK_TAG_KEY}", "Values": [stack_id]}])
-    if resp.get("InternetGateways"): out["igw_id"] = resp["InternetGateways"][0]["InternetGatewayId"]
-    resp = cli.describe_route_tables(Filters=[{"Name": f"tag:{STACK_TAG_KEY}", "Values": [stack_id]}])
-    if resp.get("RouteTables"): out["route_table_id"] = resp["RouteTables"][0]["RouteTableId"]
+    _delete_with_backoff(cli.delete_vpc, VpcId=vpc_id)
+
+def _discover_network_by_tag(cli, stack_id: str) -> Dict[str, Any]:
+    flt = [{"Name": f"tag:{STACK_TAG_KEY}", "Values": [stack_id]}]
+    # out key -> (describe call, response list key, id field); the five lookups are independent
+    lookups = {
+        "vpc_id":            (cli.describe_vpcs,              "Vpcs",             "VpcId"),
+        "subnet_id":         (cli.describe_subnets,           "Subnets",          "SubnetId"),
+        "security_group_id": (cli.describe_security_groups,   "SecurityGroups",   "GroupId"),
+        "igw_id":            (cli.describe_internet_gateways, "InternetGateways", "InternetGatewayId"),
+        "route_table_id":    (cli.describe_route_tables,      "RouteTables",      "RouteTableId"),
+    }
+    ex = aws_pool()
+    futs = {key: ex.submit(fn, Filters=flt) for key, (fn, _, _) in lookups.items()}
+    out: Dict[str, Any] = {}
+    for key, (_, list_key, id_key) in lookups.items():
+        found = futs[key].result().get(list_key) or []
+        out[key] = found[0][id_key] if found else None
+    # a VPC matched by our stack tag is one we created; no need to re-describe it to check
+    out["created_vpc"] = out["vpc_id"] is not None
     return out
 
+def _stack_network(cli, stack_id: str) -> Dict[str, Any]:
+    record = _get_stack(stack_id)
+    network = (record or {}).get("network") or {}
+    if not network:
+        network = _discover_network_by_tag(cli, stack_id)
+    return network
+
 def _destroy_stack(cli, region: str, stack_id: str, network: Dict[str, Any]):
     _terminate_instances_by_tag(cli, stack_id)
+    _delete_network(cli, network)
+
+def _wait_enis_released(cli, network: Dict[str, Any]):
+    """Poll (bounded) until no ENI still uses the stack's SG/VPC, so deletes don't hit DependencyViolation."""
+    if network.get("created_vpc") and network.get("vpc_id"):
+        flt = [{"Name": "vpc-id", "Values": [network["vpc_id"]]}]
+    elif network.get("security_group_id"):
+        flt = [{"Name": "group-id", "Values": [network["security_group_id"]]}]
+    else:
+        return
+    for _ in range(ENI_POLL_ATTEMPTS):
+        if not cli.describe_network_interfaces(Filters=flt).get("NetworkInterfaces"):
+            return
+        time.sleep(ENI_POLL_DELAY)
+
+def _delete_network(cli, network: Dict[str, Any]):
+    """Delete a stack's SG and, if we created it, its VPC pieces. Instances must be gone."""
+    created_vpc = network.get("created_vpc")
+    vpc_id = network.get("vpc_id")
+    _wait_enis_released(cli, network)
+    ex = aws_pool()
+    # SG, route table and IGW don't depend on each other: tear them down concurrently
+    futs = []
     if network.get("security_group_id"):
-        _delete_sg(cli, network["security_group_id"])
-    if network.get("created_vpc"):
-        vpc_id = network.get("vpc_id")
-        if network.get("route_table_id"):
-            _disassociate_and_delete_rt(cli, network["route_table_id"])
-        if network.get("igw_id") and vpc_id:
-            _detach_delete_igw(cli, vpc_id, network["igw_id"])
+        futs.append(ex.submit(_delete_sg, cli, network["security_group_id"]))
+    if created_vpc and network.get("route_table_id"):
+        futs.append(ex.submit(_disassociate_and_delete_rt, cli, network["route_table_id"]))
+    if created_vpc and network.get("igw_id") and vpc_id:
+        futs.append(ex.submit(_detach_delete_igw, cli, vpc_id, network["igw_id"]))
+    for f in futs:
+        f.result()
+    if created_vpc:
+        # the subnet, then the VPC, go once nothing references them
         if network.get("subnet_id"):
             _delete_subnet(cli, network["subnet_id"])
         if vpc_id:
@@ -320,9 +563,17 @@ def _destroy_stack(cli, region: str, stack_id: str, network: Dict[str, Any]):
 # ---------------------------
 # Routes
 # ---------------------------
+def _body() -> Dict[str, Any]:
+    """The request's JSON object, decoded once with orjson ({} if absent, malformed or not an object)."""
+    try:
+        body = orjson.loads(request.get_data() or b"{}")
+    except orjson.JSONDecodeError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
 @provision_bp.route("/provision/create", methods=["POST"])
 def provision_create():
-    body = request.get_json(force=True, silent=True) or {}
+    body = _body()
     region = body.get("region") or DEFAULT_REGION
     itype  = (
         body.get("type")
@@ -331,36 +582,44 @@ def provision_create():
         or request.args.get("type")
         or request.args.get("instance_type")
     )
-    vol_gb = int(body.get("volume_gb") or 20)
     tag    = body.get("tag_name") or "demo-instance"
 
     if not itype or not str(itype).strip():
         return jsonify({"error": "Missing instance type (field 'type' or 'instance_type')"}), 400
+    try:
+        vol_gb = int(body.get("volume_gb") or 20)
+    except (TypeError, ValueError):
+        return jsonify({"error": "volume_gb must be an integer"}), 400
 
     cli = ec2(region)
     stack_id = str(uuid.uuid4())
 
+    # AMI lookup only needs the instance type: resolve it while the networking is set up
+    ami_f = aws_pool().submit(_ami_for_type, cli, region, itype)
+
     # 1) choose networking
-    default_vpc_id = _find_default_vpc(cli, region)
-    if default_vpc_id:
-        subnet_id = _get_default_subnet(cli, default_vpc_id)
-        if not subnet_id:
-            net = _create_min_vpc(cli, stack_id, region)
-        else:
-            net = {"created_vpc": False, "vpc_id": default_vpc_id, "subnet_id": subnet_id,
-                   "igw_id": None, "route_table_id": None}
+    default_vpc_id, subnet_id = _default_network(cli, region)
+    if default_vpc_id and subnet_id:
+        net = {"created_vpc": False, "vpc_id": default_vpc_id, "subnet_id": subnet_id,
+               "igw_id": None, "route_table_id": None}
     else:
         net = _create_min_vpc(cli, stack_id, region)
 
-    # 2) SG
-    sg = _get_or_create_sg(cli, net["vpc_id"], stack_id)
-    net.update(sg)
+    try:
+        # 2) SG
+        sg = _create_sg(cli, net["vpc_id"], stack_id)
+        net.update(sg)
 
-    # 3) Run instance
-    inst = _run_instance(cli, region, stack_id, itype, net["subnet_id"], net["security_group_id"], tag, vol_gb)
+        # 3) Run instance
+        inst = _run_instance(cli, stack_id, itype, ami_f.result(), net["subnet_id"], net["security_group_id"], tag, vol_gb)
+    except ClientError as e:
+        # don't keep handing out a default VPC/subnet EC2 says is gone; the next create rediscovers it
+        if not net["created_vpc"]:
+            _forget_stale_default_network(region, e)
+        raise
 
     record = {"stack_id": stack_id, "region": region, "instance": inst, "network": net, "ts": int(time.time())}
-    _STACKS[stack_id] = record
+    _put_stack(record)
     return jsonify(record)
 
 @provision_bp.route("/provision/status")
@@ -370,43 +629,44 @@ def provision_status():
     if not stack_id:
         return jsonify({"error": "Missing stack_id"}), 400
 
-    record = _STACKS.get(stack_id, {"stack_id": stack_id, "region": region})
-    cli = ec2(region)
-    desc = cli.describe_instances(Filters=[{"Name": f"tag:{STACK_TAG_KEY}", "Values": [stack_id]}])
-    states = []
-    for res in desc.get("Reservations", []):
-        for i in res.get("Instances", []):
-            states.append({"id": i["InstanceId"], "state": i["State"]["Name"], "type": i.get("InstanceType"),
-                           "public_ip": i.get("PublicIpAddress")})
-    record["instances_found"] = states
+    record = dict(_get_stack(stack_id) or {"stack_id": stack_id, "region": region})
+    record["instances_found"] = _stack_instances(ec2(region), region, stack_id)
     return jsonify(record)
 
 @provision_bp.route("/provision/destroy", methods=["POST"])
 def provision_destroy():
-    body = request.get_json(force=True, silent=True) or {}
+    body = _body()
     region = body.get("region") or DEFAULT_REGION
     stack_id = body.get("stack_id")
     if not stack_id:
         return jsonify({"error": "Missing stack_id"}), 400
 
     cli = ec2(region)
-
-    record = _STACKS.get(stack_id)
-    network = (record or {}).get("network") or {}
-    if not network:
-        network = _discover_network_by_tag(cli, stack_id)
-
-    if "created_vpc" not in network or network["created_vpc"] is None:
-        created_vpc = False
-        if network.get("vpc_id"):
-            vpcs = cli.describe_vpcs(VpcIds=[network["vpc_id"]]).get("Vpcs", [])
-            if vpcs:
-                tags = {t["Key"]: t["Value"] for t in vpcs[0].get("Tags", [])}
-                created_vpc = tags.get(STACK_TAG_KEY) == stack_id
-        network["created_vpc"] = created_vpc
+    network = _stack_network(cli, stack_id)
 
     _destroy_stack(cli, region, stack_id, network)
-    if stack_id in _STACKS:
-        del _STACKS[stack_id]
+    _pop_stack(stack_id)
 
     return jsonify({"ok": True, "stack_id": stack_id, "deleted": network})
+
+@provision_bp.route("/provision/destroy_batch", methods=["POST"])
+def provision_destroy_batch():
+    """Destroy several stacks in one region, terminating all their instances in a single call."""
+    body = _body()
+    region = body.get("region") or DEFAULT_REGION
+    stack_ids = body.get("stack_ids")
+    if not isinstance(stack_ids, list) or not stack_ids:
+        return jsonify({"error": 'Provide JSON {"stack_ids": ["...", ...]}'}), 400
+    stack_ids = list(dict.fromkeys(s for s in stack_ids if isinstance(s, str) and s))
+    if not stack_ids:
+        return jsonify({"error": "stack_ids must contain at least one non-empty string"}), 400
+
+    cli = ec2(region)
+    networks = {stack_id: _stack_network(cli, stack_id) for stack_id in stack_ids}
+
+    _terminate_instances_by_tags(cli, stack_ids)
+    for stack_id, network in networks.items():
+        _delete_network(cli, network)
+        _pop_stack(stack_id)
+
+    return jsonify({"ok": True, "region": region, "deleted": networks})
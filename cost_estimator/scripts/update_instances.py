@@ -1,54 +1,61 @@
 # cost_estimator/scripts/update_instances.py
 import os
+import re
 import time
-import json
+import tempfile
+import itertools
+import threading
 import traceback
-from typing import List, Dict, Any, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List, Dict, Any, Iterable, NamedTuple, Optional, Tuple
 from pathlib import Path
 
+import ijson
+import numpy as np
+import orjson
 import requests
-import boto3
-from botocore.config import Config
 from flask import Blueprint, request, jsonify
 
+try:
+    import fcntl  # POSIX; the Windows debug server is a single process, _price_lock suffices there
+except ImportError:
+    fcntl = None
+
+from aws_clients import ec2 as ec2_client
+
 rec_bp = Blueprint("recommendations", __name__)
 
 # =========================
 # Config
 # =========================
 TARGET_REGION_CODE = os.getenv("TARGET_REGION_CODE", "us-east-1")
-INSTANCE_FAMILY_FILTERS = [
+# family prefixes (e.g. "m5,c6g"), expanded server-side as instance-type wildcards
+INSTANCE_FAMILY_FILTERS = tuple(
     s.strip().lower()
     for s in os.getenv("INSTANCE_FAMILY_FILTERS", "").split(",")
     if s.strip()
-]
+)
 MAX_CANDIDATES = int(os.getenv("MAX_CANDIDATES", "20"))
-AWS_PROFILE_NAME = os.getenv("AWS_PROFILE") or os.getenv("CLOUD_MIGRATION_AWS_PROFILE")
+SPEC_WORKERS = max(1, int(os.getenv("SPEC_WORKERS", "8")))  # concurrent DescribeInstanceTypes batches
 CACHE_TTL = int(os.getenv("CACHE_TTL", str(24 * 60 * 60)))
 
 DATA_DIR = Path(__file__).resolve().parents[1] / "data"
 PRICE_DIR = DATA_DIR / "pricing"
 PRICE_DIR.mkdir(parents=True, exist_ok=True)
+CACHE_DIR = DATA_DIR / "cache"
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 # Public AWS offer endpoints (no IAM/credentials needed)
 OFFER_BASE = "https://pricing.us-east-1.amazonaws.com"
 REGION_INDEX = f"{OFFER_BASE}/offers/v1.0/aws/AmazonEC2/current/region_index.json"
+OFFER_INDEX_TTL = int(os.getenv("OFFER_INDEX_TTL", "3600"))
+# one keep-alive session for the pricing endpoint (index + offer files)
+_HTTP = requests.Session()
 
 # =========================
-# EC2 specs (unchanged)
+# EC2 specs: fetch, on-disk cache, NumPy snapshot, eligibility
 # =========================
-def _session():
-    if AWS_PROFILE_NAME:
-        return boto3.session.Session(profile_name=AWS_PROFILE_NAME)
-    return boto3.session.Session()
-
-def ec2_client(region_code: str):
-    return _session().client(
-        "ec2",
-        region_name=region_code,
-        config=Config(retries={"max_attempts": 10, "mode": "standard"}),
-    )
-
 def _chunked(seq: List[str], n: int) -> Iterable[List[str]]:
     for i in range(0, len(seq), n):
         yield seq[i : i + n]
@@ -56,68 +63,221 @@ def _chunked(seq: List[str], n: int) -> Iterable[List[str]]:
 def _mib_to_gib(mib: int) -> float:
     return round(mib / 1024.0, 3)
 
-def _matches_families(instance_type: str) -> bool:
-    if not INSTANCE_FAMILY_FILTERS:
-        return True
-    t = instance_type.lower()
-    return any(t.startswith(prefix) for prefix in INSTANCE_FAMILY_FILTERS)
-
-_specs_cache: Dict[str, Any] = {"ts": 0, "region": None, "rows": None}
+class _Specs(NamedTuple):
+    """
+    One generation of the specs cache. "rows" keeps the spec dicts sorted by
+    (vCPU, memory_GB); "vcpu"/"mem" are column arrays aligned to it for filtering.
+    Published with a single assignment, so a reader holding one never mixes the
+    arrays of one load with the rows of another.
+    """
+    region: Optional[str]
+    ts: float
+    rows: Optional[List[Dict[str, Any]]]
+    vcpu: Optional[np.ndarray]
+    mem: Optional[np.ndarray]
+    version: int
+
+_specs_cache = _Specs(region=None, ts=0.0, rows=None, vcpu=None, mem=None, version=0)
+_specs_versions = itertools.count(1)
+# (specs version, cpu, ram, limit) -> shortlisted rows; plain-value keys so entries never pin
+# an old generation's arrays, and cleared whenever a new snapshot is published
+_SHORTLISTS: Dict[tuple, tuple] = {}
+SHORTLIST_MEMO_MAX = 512  # dashboards poll a handful of (cpu, ram) sizes over and over
+# one specs load/refresh at a time; concurrent cold requests wait for it instead of repeating it
+_specs_lock = threading.Lock()
+
+# region -> {"mtime": snapshot st_mtime_ns, "prices": {instanceType: usd_per_hr}}
+_PRICE_MAP: Dict[str, Dict[str, Any]] = {}
+# single-flight guard: a missing/invalid snapshot triggers a full offer-file rebuild,
+# which concurrent requests must not each start
+_price_lock = threading.Lock()
+# {"ts": fetched_at, "urls": {region: current offer file URL}}
+_OFFER_INDEX: Dict[str, Any] = {"ts": 0, "urls": None}
 
 def list_offered_instance_types(region_code: str) -> List[str]:
     cli = ec2_client(region_code)
-    types: List[str] = []
+    types = set()
     paginator = cli.get_paginator("describe_instance_type_offerings")
     for page in paginator.paginate(
-        LocationType="region", Filters=[{"Name": "location", "Values": [region_code]}]
+        LocationType="region",
+        Filters=[{"Name": "location", "Values": [region_code]}],
+        PaginationConfig={"PageSize": 1000},  # API maximum; fewer round-trips per listing
     ):
-        for it in page.get("InstanceTypeOfferings", []):
-            itype = it.get("InstanceType")
-            if itype and _matches_families(itype):
-                types.append(itype)
-    return sorted(list(set(types)))
+        types.update(it.get("InstanceType") for it in page.get("InstanceTypeOfferings", []))
+    types -= {None, ""}
+    # only the unfiltered refresh lists offerings; family filters go through describe_family_specs
+    return sorted(types)
 
 def describe_instance_specs(
     region_code: str, instance_types: List[str]
 ) -> List[Dict[str, Any]]:
     cli = ec2_client(region_code)
+    batches = list(_chunked(instance_types, 100))
+    if not batches:
+        return []
     out: List[Dict[str, Any]] = []
-    for batch in _chunked(instance_types, 100):
-        resp = cli.describe_instance_types(InstanceTypes=batch)
-        for it in resp.get("InstanceTypes", []):
-            itype = it.get("InstanceType")
-            vcpus = it.get("VCpuInfo", {}).get("DefaultVCpus")
-            mem_mib = it.get("MemoryInfo", {}).get("SizeInMiB")
-            if not (itype and isinstance(vcpus, int) and isinstance(mem_mib, int)):
-                continue
-            out.append(
-                {"instance_type": itype, "vCPU": vcpus, "memory_GB": _mib_to_gib(mem_mib)}
-            )
+    # one DescribeInstanceTypes per 100 types; issue the batches concurrently on one shared client
+    with ThreadPoolExecutor(max_workers=min(SPEC_WORKERS, len(batches))) as ex:
+        responses = list(ex.map(lambda b: cli.describe_instance_types(InstanceTypes=b), batches))
+    for resp in responses:
+        out.extend(_spec_rows(resp))
     return out
 
-def _ensure_specs_cache(region_code: str):
-    now = time.time()
-    if (
-        _specs_cache["rows"] is not None
-        and _specs_cache["region"] == region_code
-        and (now - _specs_cache["ts"]) < CACHE_TTL
+def describe_family_specs(region_code: str) -> List[Dict[str, Any]]:
+    """Specs for INSTANCE_FAMILY_FILTERS only, expanded server-side via wildcard filters."""
+    cli = ec2_client(region_code)
+    out: List[Dict[str, Any]] = []
+    for page in cli.get_paginator("describe_instance_types").paginate(
+        Filters=[{"Name": "instance-type", "Values": [f"{fam}*" for fam in INSTANCE_FAMILY_FILTERS]}],
+        PaginationConfig={"PageSize": 100},  # API maximum
     ):
-        return
-    offered = list_offered_instance_types(region_code)
-    if not offered:
-        raise RuntimeError(f"No EC2 instance type offerings in {region_code}")
-    specs = describe_instance_specs(region_code, offered)
-    _specs_cache["rows"] = specs
-    _specs_cache["region"] = region_code
-    _specs_cache["ts"] = now
-
-def _eligible_specs(req_cpu: int, req_ram_gb: float) -> List[Dict[str, Any]]:
-    rows = [
-        r for r in _specs_cache["rows"]
-        if r["vCPU"] >= req_cpu and r["memory_GB"] >= req_ram_gb
-    ]
-    rows.sort(key=lambda r: (r["vCPU"], r["memory_GB"]))
-    return rows
+        out.extend(_spec_rows(page))
+    return out
+
+def _spec_rows(resp: Dict[str, Any]) -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    for it in resp.get("InstanceTypes", []):
+        itype = it.get("InstanceType")
+        vcpus = it.get("VCpuInfo", {}).get("DefaultVCpus")
+        mem_mib = it.get("MemoryInfo", {}).get("SizeInMiB")
+        if not (itype and isinstance(vcpus, int) and isinstance(mem_mib, int)):
+            continue
+        out.append(
+            {"instance_type": itype, "vCPU": vcpus, "memory_GB": _mib_to_gib(mem_mib)}
+        )
+    return out
+
+def _specs_file(region_code: str) -> Path:
+    return CACHE_DIR / f"specs_{region_code}.json"
+
+def _set_specs_cache(region_code: str, rows: List[Dict[str, Any]], ts: float) -> _Specs:
+    global _specs_cache
+    # sort once here so every request can reuse the ordering
+    rows = sorted(rows, key=lambda r: (r["vCPU"], r["memory_GB"]))
+    n = len(rows)
+    _specs_cache = _Specs(
+        region=region_code,
+        ts=ts,
+        rows=rows,
+        vcpu=np.fromiter((r["vCPU"] for r in rows), dtype=np.int32, count=n),
+        mem=np.fromiter((r["memory_GB"] for r in rows), dtype=np.float64, count=n),
+        version=next(_specs_versions),
+    )
+    _SHORTLISTS.clear()
+    return _specs_cache
+
+def _write_durable(path: Path, data: bytes) -> int:
+    """
+    Atomically replace `path` with `data`, fsyncing the file before the rename and the
+    directory after it, so a crash leaves either the old or the new file, never a torn
+    one that forces a full rebuild on the next start. Returns the new file's st_mtime_ns.
+    """
+    # per-process temp name so concurrent workers never interleave writes
+    tmp = path.with_suffix(f"{path.suffix}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        mtime = os.fstat(f.fileno()).st_mtime_ns  # the rename keeps it
+    tmp.replace(path)
+    dir_fd = os.open(path.parent, os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return mtime
+
+def _save_specs_file(region_code: str, rows: List[Dict[str, Any]], ts: float):
+    _write_durable(
+        _specs_file(region_code),
+        # the family filters the rows were built under; a restart with other filters must not reuse them
+        orjson.dumps({"region": region_code, "ts": ts, "filters": list(INSTANCE_FAMILY_FILTERS), "rows": rows}),
+    )
+
+def _load_specs_file(region_code: str) -> bool:
+    """
+    Rehydrate _specs_cache from disk if the on-disk copy is still within CACHE_TTL and
+    was built under the current INSTANCE_FAMILY_FILTERS.
+    """
+    sf = _specs_file(region_code)
+    if not sf.exists():
+        return False
+    try:
+        data = orjson.loads(sf.read_bytes())
+    except Exception:
+        return False
+    if data.get("filters") != list(INSTANCE_FAMILY_FILTERS):
+        return False
+    rows = data.get("rows")
+    ts = float(data.get("ts") or 0)
+    if not isinstance(rows, list) or not rows or (time.time() - ts) >= CACHE_TTL:
+        return False
+    _set_specs_cache(region_code, rows, ts)
+    return True
+
+def _refresh_specs_cache(region_code: str):
+    if INSTANCE_FAMILY_FILTERS:
+        # DescribeInstanceTypes only returns types offered in the region and accepts
+        # wildcards, so one paginated call replaces the full offerings listing + batches
+        specs = describe_family_specs(region_code)
+        if not specs:
+            raise RuntimeError(f"No EC2 instance types matching {INSTANCE_FAMILY_FILTERS} in {region_code}")
+    else:
+        offered = list_offered_instance_types(region_code)
+        if not offered:
+            raise RuntimeError(f"No EC2 instance type offerings in {region_code}")
+        specs = describe_instance_specs(region_code, offered)
+    now = time.time()
+    snap = _set_specs_cache(region_code, specs, now)
+    try:
+        _save_specs_file(region_code, snap.rows, now)
+    except OSError as e:
+        print("WARN: could not write specs cache:", e)
+    return snap
+
+def _fresh_specs(region_code: str) -> Optional[_Specs]:
+    specs = _specs_cache  # one reference: checked and returned as a whole
+    if specs.rows is not None and specs.region == region_code and (time.time() - specs.ts) < CACHE_TTL:
+        return specs
+    return None
+
+def _ensure_specs_cache(region_code: str) -> _Specs:
+    """The region's specs snapshot, loading it from disk or EC2 if needed."""
+    specs = _fresh_specs(region_code)
+    if specs is not None:
+        return specs
+    with _specs_lock:
+        # another thread may have loaded it while we waited
+        specs = _fresh_specs(region_code)
+        if specs is not None:
+            return specs
+        if _load_specs_file(region_code):
+            return _specs_cache
+        return _refresh_specs_cache(region_code)
+
+def _eligible_idx(specs: _Specs, req_cpu: int, req_ram_gb: float) -> np.ndarray:
+    """Indices into specs.rows meeting the request, ordered by (vCPU, memory_GB)."""
+    # rows are pre-sorted: everything from the first vCPU match onward qualifies on CPU,
+    # and filtering that suffix on memory keeps the (vCPU, memory_GB) order
+    start = int(np.searchsorted(specs.vcpu, req_cpu, side="left"))
+    return start + np.flatnonzero(specs.mem[start:] >= req_ram_gb)
+
+def _eligible_specs(specs: _Specs, req_cpu: int, req_ram_gb: float,
+                    limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    # the version in the key keeps a request still holding an older snapshot from
+    # reading (or seeding) the current generation's entries
+    key = (specs.version, req_cpu, req_ram_gb, limit)
+    hit = _SHORTLISTS.get(key)
+    if hit is None:
+        idx = _eligible_idx(specs, req_cpu, req_ram_gb)
+        if limit is not None:
+            idx = idx[:limit]
+        rows = specs.rows
+        hit = tuple(rows[i] for i in idx)
+        if len(_SHORTLISTS) >= SHORTLIST_MEMO_MAX:
+            _SHORTLISTS.clear()  # arbitrary (cpu, ram) queries mustn't grow it without bound
+        _SHORTLISTS[key] = hit
+    return list(hit)
 
 # =========================
 # Pricing snapshot (public offers)
@@ -126,174 +286,258 @@ def _price_file(region: str) -> Path:
     return PRICE_DIR / f"ec2_prices_{region}.json"
 
 def _region_offer_url(region: str) -> str:
-    r = requests.get(REGION_INDEX, timeout=60)
-    r.raise_for_status()
-    rel = r.json()["regions"][region]["currentVersionUrl"]
-    return f"{OFFER_BASE}{rel}"
+    # The index maps every region to its current offer version and only changes when AWS
+    # publishes new prices; re-fetch it at most every OFFER_INDEX_TTL
+    now = time.time()
+    if _OFFER_INDEX["urls"] is None or (now - _OFFER_INDEX["ts"]) >= OFFER_INDEX_TTL:
+        r = _HTTP.get(REGION_INDEX, timeout=60)
+        r.raise_for_status()
+        _OFFER_INDEX["urls"] = {
+            code: f"{OFFER_BASE}{meta['currentVersionUrl']}"
+            for code, meta in r.json()["regions"].items()
+        }
+        _OFFER_INDEX["ts"] = now
+    return _OFFER_INDEX["urls"][region]
+
+def _read_snapshot(region: str) -> Tuple[Optional[Dict[str, Any]], Optional[int]]:
+    """
+    (parsed snapshot, its st_mtime_ns). The mtime comes from the same open file as the
+    bytes, so a concurrent atomic replace can't pair old prices with the new mtime.
+    """
+    try:
+        with open(_price_file(region), "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            data = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None, None
+    return (data if isinstance(data, dict) else None), mtime
+
+def _validators(snap: Optional[Dict[str, Any]], url: str) -> Dict[str, str]:
+    """Conditional-GET headers from a valid snapshot of the same offer version."""
+    if not snap or snap.get("source_url") != url:
+        return {}
+    prices = snap.get("prices")
+    if not isinstance(prices, dict) or not prices or _has_zero_entries(prices):
+        return {}
+    headers = {}
+    if snap.get("etag"):
+        headers["If-None-Match"] = snap["etag"]
+    if snap.get("last_modified"):
+        headers["If-Modified-Since"] = snap["last_modified"]
+    return headers
+
+# Plain substring keywords (matched anywhere in the lowercased description), compiled
+# into one alternation each so a dimension is checked in two scans instead of fifteen
+_BOXUSAGE_ALLOW = ("on demand", "boxusage", "instance-hour", "instance hours", "instance-hours")
+_BOXUSAGE_DENY = ("dedicated host", "per host", "host reservation", "reserved instance",
+                  "upfront", "prepay", "cpu credits", "ebs", "io", "provisioned iops")
+_ALLOW_RE = re.compile("|".join(map(re.escape, _BOXUSAGE_ALLOW)))
+_DENY_RE = re.compile("|".join(map(re.escape, _BOXUSAGE_DENY)))
 
 def _is_boxusage_dimension(desc: str) -> bool:
     """True only for On-Demand instance-hours (not hosts, not add-ons)."""
     if not desc:
         return False
     d = desc.lower()
-    allow = ("on demand", "boxusage", "instance-hour", "instance hours", "instance-hours")
-    deny  = ("dedicated host", "per host", "host reservation", "reserved instance",
-             "upfront", "prepay", "cpu credits", "ebs", "io", "provisioned iops")
-    if not any(k in d for k in allow):
-        return False
-    if any(k in d for k in deny):
-        return False
-    return True
+    return _ALLOW_RE.search(d) is not None and _DENY_RE.search(d) is None
 
-def _build_price_map_public(region: str) -> Dict[str, float]:
+def _sku_hourly_usd(sku_terms: Dict[str, Any], boxusage_only: bool = True) -> Optional[float]:
     """
-    Build {instanceType: price_per_hour} for On-Demand Linux, Shared tenancy.
-    Filters strictly to BoxUsage (instance-hour) dimensions and ignores $0 add-ons.
+    First positive $/Hr rate in a SKU's On-Demand terms. Offer files carry one
+    On-Demand offer with a single instance-hour dimension per SKU, so the first
+    match is the answer; the min across SKUs is taken by the caller.
     """
-    url = _region_offer_url(region)
-    r = requests.get(url, timeout=180)
-    r.raise_for_status()
-    offer = r.json()
-    products = offer.get("products", {})
-    terms_all = (offer.get("terms") or {}).get("OnDemand", {})
+    for term in sku_terms.values():
+        for dim in term.get("priceDimensions", {}).values():
+            if dim.get("unit") != "Hrs":
+                continue
+            if boxusage_only and not _is_boxusage_dimension(dim.get("description") or ""):
+                continue
+            try:
+                v = float(dim["pricePerUnit"]["USD"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if v > 0:  # ignore $0 dimensions like CPU credits, metadata, etc.
+                return v
+    return None
 
+def _scan_ondemand(fh, sku_types: Dict[str, str], boxusage_only: bool) -> Dict[str, float]:
+    """One streaming pass over terms.OnDemand: min $/Hr per instanceType for the given SKUs."""
+    fh.seek(0)
     prices: Dict[str, float] = {}
-    for sku, prod in products.items():
-        attrs = (prod or {}).get("attributes") or {}
-        fam = attrs.get("productFamily", "")
-        if "Compute Instance" not in fam:  # includes bare metal
-            continue
-        if attrs.get("operatingSystem") != "Linux":
-            continue
-        tenancy = attrs.get("tenancy") or "Shared"
-        if tenancy != "Shared":
-            continue
-        # preInstalledSw may be missing; only skip if clearly not NA-like
-        pis = (attrs.get("preInstalledSw") or "").upper()
-        if pis and pis not in ("NA", "NONE", "N/A"):
-            continue
-        itype = attrs.get("instanceType")
-        if not itype:
+    for sku, sku_terms in ijson.kvitems(fh, "terms.OnDemand", use_float=True):
+        itype = sku_types.get(sku)
+        if itype is None:
             continue
-
-        # Cheapest BoxUsage $/Hr across dimensions for this SKU
-        best = None
-        for term in (terms_all.get(sku) or {}).values():
-            for dim in (term.get("priceDimensions") or {}).values():
-                if not isinstance(dim, dict):
-                    continue
-                if dim.get("unit") != "Hrs":
-                    continue
-                if not _is_boxusage_dimension(dim.get("description") or ""):
-                    continue
-                usd = (dim.get("pricePerUnit") or {}).get("USD")
-                if not usd:
-                    continue
-                try:
-                    v = float(usd)
-                except Exception:
-                    continue
-                if v <= 0:
-                    # ignore $0 dimensions like CPU credits, metadata, etc.
-                    continue
-                best = v if (best is None or v < best) else best
-
+        best = _sku_hourly_usd(sku_terms or {}, boxusage_only=boxusage_only)
         if best is None:
             continue
-
-        # Keep minimum across SKUs mapping to same instanceType
-        if (itype not in prices) or (best < prices[itype]):
+        # Keep minimum across SKUs mapping to same instanceType (one lookup per SKU)
+        cur = prices.get(itype)
+        if cur is None or best < cur:
             prices[itype] = best
+    return prices
 
-    # Last-resort relax: if nothing captured, at least keep Linux regardless of family/tenancy quirks
-    if not prices:
-        for sku, prod in products.items():
+def _build_price_map_public(region: str) -> Dict[str, float]:
+    """
+    Build {instanceType: price_per_hour} for On-Demand Linux, Shared tenancy.
+    Filters strictly to BoxUsage (instance-hour) dimensions and ignores $0 add-ons.
+    """
+    url = _region_offer_url(region)
+    snap, snap_mtime = _read_snapshot(region)
+    with _HTTP.get(url, headers=_validators(snap, url), stream=True, timeout=180) as r, \
+            tempfile.TemporaryFile() as fh:
+        if r.status_code == 304:
+            # Offer unchanged since our snapshot: keep the file, skip the download and parse
+            prices = snap["prices"]
+            _PRICE_MAP[region] = {"mtime": snap_mtime, "prices": prices}
+            return prices
+        r.raise_for_status()
+        etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+        # Offer files are hundreds of MB: spool the download to disk and stream-parse it with
+        # ijson, so only one product / one SKU's terms is ever materialized at a time
+        for chunk in r.iter_content(chunk_size=1 << 20):
+            fh.write(chunk)
+
+        # Pass 1: products -> which SKUs we want, and their instanceType
+        fh.seek(0)
+        linux: Dict[str, str] = {}   # every Linux SKU (last-resort fallback below)
+        wanted: Dict[str, str] = {}  # Linux / Shared / Compute Instance / no pre-installed software
+        for sku, prod in ijson.kvitems(fh, "products", use_float=True):
             attrs = (prod or {}).get("attributes") or {}
             if attrs.get("operatingSystem") != "Linux":
                 continue
             itype = attrs.get("instanceType")
             if not itype:
                 continue
-            best = None
-            for term in (terms_all.get(sku) or {}).values():
-                for dim in (term.get("priceDimensions") or {}).values():
-                    if not isinstance(dim, dict) or dim.get("unit") != "Hrs":
-                        continue
-                    usd = (dim.get("pricePerUnit") or {}).get("USD")
-                    if not usd:
-                        continue
-                    try:
-                        v = float(usd)
-                    except Exception:
-                        continue
-                    if v <= 0:
-                        continue
-                    best = v if (best is None or v < best) else best
-            if best is not None and ((itype not in prices) or (best < prices[itype])):
-                prices[itype] = best
+            linux[sku] = itype
+            fam = attrs.get("productFamily", "")
+            if "Compute Instance" not in fam:  # includes bare metal
+                continue
+            tenancy = attrs.get("tenancy") or "Shared"
+            if tenancy != "Shared":
+                continue
+            # preInstalledSw may be missing; only skip if clearly not NA-like
+            pis = (attrs.get("preInstalledSw") or "").upper()
+            if pis and pis not in ("NA", "NONE", "N/A"):
+                continue
+            wanted[sku] = itype
+
+        # Pass 2: On-Demand terms, only for the wanted SKUs
+        prices = _scan_ondemand(fh, wanted, boxusage_only=True)
+
+        # Last-resort relax: if nothing captured, at least keep Linux regardless of family/tenancy quirks
+        if not prices:
+            prices = _scan_ondemand(fh, linux, boxusage_only=False)
 
     # Write trimmed snapshot
     pf = _price_file(region)
-    tmp = pf.with_suffix(".json.tmp")
-    tmp.write_text(
-        json.dumps(
+    mtime = _write_durable(
+        pf,
+        orjson.dumps(
             {
                 "region": region,
                 "updated": int(time.time()),
                 "count": len(prices),
                 "prices": prices,
                 "source_url": url,
+                "etag": etag,
+                "last_modified": last_modified,
             },
-            indent=2,
+            option=orjson.OPT_INDENT_2,
         ),
-        encoding="utf-8",
     )
-    tmp.replace(pf)
+    _PRICE_MAP[region] = {"mtime": mtime, "prices": prices}
     return prices
 
 def _ensure_price_file(region: str) -> Dict[str, float]:
-    pf = _price_file(region)
-    if pf.exists():
-        try:
-            data = json.loads(pf.read_text(encoding="utf-8"))
-            prices = data.get("prices") or {}
-            # only reuse if non-empty and no zeros
-            if isinstance(prices, dict) and prices and not _has_zero_entries(prices):
-                return prices
-        except Exception:
-            pass
-    # Build (or rebuild) from public offers
+    """Load the snapshot into _PRICE_MAP (with the mtime of the file actually read), or rebuild it."""
+    data, mtime = _read_snapshot(region)
+    prices = (data or {}).get("prices") or {}
+    # only reuse if non-empty and no zeros
+    if isinstance(prices, dict) and prices and not _has_zero_entries(prices):
+        _PRICE_MAP[region] = {"mtime": mtime, "prices": prices}
+        return prices
+    # Build (or rebuild) from public offers; records its own _PRICE_MAP entry
     return _build_price_map_public(region)
 
+def _snapshot_mtime(region: str) -> Optional[int]:
+    try:
+        return _price_file(region).stat().st_mtime_ns
+    except OSError:
+        return None
+
+@contextmanager
+def _price_build_lock(region: str):
+    """
+    Cross-process counterpart of _price_lock: gunicorn workers share PRICE_DIR, so on a
+    cold disk one of them builds the snapshot while the others block here and then read it.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(PRICE_DIR / f".ec2_prices_{region}.lock", "wb") as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
 def _load_price_map(region: str) -> Dict[str, float]:
-    prices = _ensure_price_file(region)
-    if not prices:
-        raise RuntimeError(f"No prices available for {region}.")
-    return prices
+    """
+    Serve the region's price map from memory for as long as the snapshot file is
+    unchanged. Snapshots are replaced atomically, so a new mtime means a rebuild
+    (this worker's, another worker's, or fetch_ec2_prices_public.py) to pick up.
+    """
+    mtime = _snapshot_mtime(region)
+    cached = _PRICE_MAP.get(region)
+    if cached is not None and mtime is not None and cached["mtime"] == mtime:
+        return cached["prices"]
+    with _price_lock:
+        # another thread may have loaded it while we waited
+        mtime = _snapshot_mtime(region)
+        cached = _PRICE_MAP.get(region)
+        if cached is not None and mtime is not None and cached["mtime"] == mtime:
+            return cached["prices"]
+        # _ensure_price_file re-reads the snapshot first, so a worker that waited here on
+        # another worker's build loads its result instead of building again
+        with _price_build_lock(region):
+            prices = _ensure_price_file(region)
+        if not prices:
+            raise RuntimeError(f"No prices available for {region}.")
+        return prices
 
 def prices_for_types(instance_types: List[str], region: str) -> List[Dict[str, Any]]:
-    seen = set()
-    ordered = [it for it in instance_types if isinstance(it, str) and not (it in seen or seen.add(it))]
+    # dict.fromkeys dedups in C and keeps first-seen order
+    ordered = dict.fromkeys(it for it in instance_types if isinstance(it, str))
     price_map = _load_price_map(region)
     return [{"instance_type": it, "price_per_hour": price_map.get(it)} for it in ordered]
 
+def _attach_prices(rows: List[Dict[str, Any]], region: str) -> List[Dict[str, Any]]:
+    """Price a whole shortlist against one load of the region's price map."""
+    price_map = _load_price_map(region)
+    return [{**r, "price_per_hour": price_map.get(r["instance_type"])} for r in rows]
+
 # =========================
 # Warm on startup
 # =========================
 def warm_rec_cache():
-    print("Warming EC2 offerings/specs cache...")
-    offered = list_offered_instance_types(TARGET_REGION_CODE)
-    _specs_cache["rows"] = describe_instance_specs(TARGET_REGION_CODE, offered)
-    _specs_cache["region"] = TARGET_REGION_CODE
-    _specs_cache["ts"] = time.time()
-    print("Cache warm complete. Types cached:", len(_specs_cache["rows"]))
-
-    # Ensure a valid price file exists
-    try:
-        prices = _ensure_price_file(TARGET_REGION_CODE)
-        print(f"Price file ready for {TARGET_REGION_CODE}: {len(prices)} entries at {_price_file(TARGET_REGION_CODE)}")
-    except Exception as e:
-        print("WARN: could not prepare price file:", e)
+    # The price build (offer download) and the specs refresh (EC2 API batches) are
+    # independent; run the price side in the background so a cold start waits for the
+    # slower of the two instead of their sum
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="warm-prices") as pool:
+        prices_future = pool.submit(_load_price_map, TARGET_REGION_CODE)
+
+        print("Warming EC2 offerings/specs cache...")
+        specs = _ensure_specs_cache(TARGET_REGION_CODE)  # reuses the on-disk copy across restarts
+        print("Cache warm complete. Types cached:", len(specs.rows))
+
+        # Ensure a valid price file exists
+        try:
+            prices = prices_future.result()
+            print(f"Price file ready for {TARGET_REGION_CODE}: {len(prices)} entries at {_price_file(TARGET_REGION_CODE)}")
+        except Exception as e:
+            print("WARN: could not prepare price file:", e)
 
 # put this near the other helpers
 def _has_zero_entries(prices: Dict[str, float]) -> bool:
@@ -318,7 +562,7 @@ def prices_status():
     meta = None
     if pf.exists():
         try:
-            meta = json.loads(pf.read_text(encoding="utf-8"))
+            meta = orjson.loads(pf.read_bytes())
         except Exception:
             meta = None
     return jsonify({
@@ -333,7 +577,8 @@ def prices_status():
 def prices_refresh():
     region = request.args.get("region", TARGET_REGION_CODE)
     try:
-        prices = _build_price_map_public(region)
+        with _price_lock, _price_build_lock(region):
+            prices = _build_price_map_public(region)
         return jsonify({"ok": True, "region": region, "count": len(prices)})
     except Exception as e:
         traceback.print_exc()
@@ -345,9 +590,10 @@ def debug_eligibles():
         req_cpu = int(request.args.get("cpu", "1"))
         req_ram = float(request.args.get("ram", "1"))
         region = request.args.get("region", TARGET_REGION_CODE)
-        _ensure_specs_cache(region)
-        rows = _eligible_specs(req_cpu, req_ram)
-        return jsonify({"region": region, "eligible_count": len(rows), "first_20": rows[:20]})
+        specs = _ensure_specs_cache(region)
+        idx = _eligible_idx(specs, req_cpu, req_ram)
+        rows = specs.rows
+        return jsonify({"region": region, "eligible_count": int(idx.size), "first_20": [rows[i] for i in idx[:20]]})
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
@@ -361,24 +607,24 @@ def optimize():
         req_ram = float(data.get("ram_gb", 1))
         region = data.get("region", TARGET_REGION_CODE)
 
-        _ensure_specs_cache(region)
+        specs = _ensure_specs_cache(region)
         # shortlist (same MAX_CANDIDATES logic you already use)
-        rows = _eligible_specs(req_cpu, req_ram)[:max(1, MAX_CANDIDATES)]
+        rows = _eligible_specs(specs, req_cpu, req_ram, limit=max(1, MAX_CANDIDATES))
         if not rows:
             return jsonify({"error": "No instances meet the requirements in this region"}), 404
 
-        # price them from the snapshot
-        names = [r["instance_type"] for r in rows]
-        price_list = prices_for_types(names, region)
-        pmap = {p["instance_type"]: p["price_per_hour"] for p in price_list}
-
-        priced = [{**r, "price_per_hour": pmap.get(r["instance_type"])} for r in rows]
-        # pick lowest positive (or lowest non-null if all zeros/None)
-        valid = [r for r in priced if r["price_per_hour"] not in (None, 0)]
-        best = min(valid, key=lambda r: r["price_per_hour"]) if valid else min(
-            priced, key=lambda r: (float("inf") if r["price_per_hour"] in (None, 0) else r["price_per_hour"])
-        )
-        return jsonify(best)
+        # price them from the snapshot and keep the lowest positive price in the same pass,
+        # building only the winning row (first shortlisted row if none is priced)
+        price_map = _load_price_map(region)
+        best, best_price = None, None
+        for r in rows:
+            p = price_map.get(r["instance_type"])
+            if p not in (None, 0) and (best is None or p < best_price):
+                best, best_price = r, p
+        if best is None:
+            best = rows[0]
+            best_price = price_map.get(best["instance_type"])
+        return jsonify({**best, "price_per_hour": best_price})
     except Exception as e:
         traceback.print_exc()
         return jsonify({"error": "Unhandled server error", "details": str(e)}), 500
@@ -390,14 +636,8 @@ def recommend_with_prices():
         req_ram = float(request.args.get("ram", "1"))
         region = request.args.get("region", TARGET_REGION_CODE)
 
-        _ensure_specs_cache(region)
-        rows = _eligible_specs(req_cpu, req_ram)[: max(1, MAX_CANDIDATES)]
-
-        types = [r["instance_type"] for r in rows]
-        priced = prices_for_types(types, region)
-        pmap = {p["instance_type"]: p["price_per_hour"] for p in priced}
-        for r in rows:
-            r["price_per_hour"] = pmap.get(r["instance_type"])
+        specs = _ensure_specs_cache(region)
+        rows = _attach_prices(_eligible_specs(specs, req_cpu, req_ram, limit=max(1, MAX_CANDIDATES)), region)
 
         return jsonify({"region": region, "count": len(rows), "rows": rows})
     except Exception as e:
@@ -0,0 +1,23 @@
+# cost_estimator/scripts/wsgi.py
+# Production entrypoint (app.py's __main__ is the single-threaded debug server):
+#   cd cost_estimator/scripts
+#   gunicorn -w 4 -k gthread --threads 8 wsgi:app
+#
+# Don't add --preload: the warm-up below opens boto3 connections, which must not be
+# shared across forked workers. Each worker warms itself in a background thread, since a
+# cold price build can outlast gunicorn's boot --timeout. On a cold disk one worker builds
+# the price snapshot (file lock in update_instances) and the others read it.
+import threading
+
+from app import create_app
+from update_instances import warm_rec_cache
+
+app = create_app()
+
+def _warm():
+    try:
+        warm_rec_cache()  # warm EC2 offerings/specs cache + price map for this worker
+    except Exception as e:
+        print("Warm-up skipped:", e)
+
+threading.Thread(target=_warm, name="warm-rec-cache", daemon=True).start()